@@ -130,9 +130,7 @@ class FeatureMining:
         gflm_section = self.gflm.gflm_section
 
         # feature text equivalence
-        feat_dict = {}
-        for index, raw in feature_list.iterrows():
-            feat_dict[raw['feature_id']] = raw['feature']
+        feat_dict = dict(zip(feature_list['feature_id'].values, feature_list['feature'].values))
 
 
         # gflm_word
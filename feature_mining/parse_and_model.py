@@ -5,6 +5,7 @@ import numpy as np
 from scipy.sparse import csr_matrix
 import nltk
 from nltk.tokenize import sent_tokenize
+from spacy.attrs import LOWER, LEMMA, IS_STOP, IS_PUNCT, IS_SPACE
 from spacy.cli.download import download as spacy_download
 try:
     import en_core_web_sm
@@ -13,10 +14,72 @@ except ImportError:
     spacy_download("en_core_web_sm")
     import en_core_web_sm
 from collections import Counter, defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice, repeat
 import time
 import os
+import sys
 from enum import Enum, auto
 
+# Spacy model shared by all ParseAndModel instances, loaded on first use
+_nlp = None
+
+
+def _get_nlp():
+    """
+    Loads the Spacy en_core_web_sm model once and caches it at module level.
+
+    :return: the cached Spacy Language object
+    """
+    global _nlp
+    if _nlp is None:
+        logging.info(" >Loading Spacy en_core_web_sm model.")
+        # parser and ner are not needed for lemmas/stop words, the tagger is kept since the lemmatizer uses its tags
+        _nlp = en_core_web_sm.load(disable=['parser', 'ner'])
+    return _nlp
+
+
+def _parse_sections(texts: list, remove_stopwords: bool = True, lemmatize_words: bool = True) -> list:
+    """
+    Runs section texts through Spacy and returns the cleaned words of each section. Kept at module level so it can be
+    sent to worker processes by build_explicit_models.
+
+    :param texts: list of section texts
+    :param remove_stopwords: Set to true if stop words should be removed
+    :param lemmatize_words: Set to true if words should be lemmatized
+    :return: a list with the list of cleaned words for each section, in input order
+    """
+    nlp = _get_nlp()
+
+    # hash lookups shared by all sections
+    strings = nlp.vocab.strings
+    pron_hash = np.uint64(strings['-PRON-'])
+
+    # stream sections through Spacy in batches
+    docs = nlp.pipe(texts, batch_size=int(os.getenv('FM_SPACY_BS', '1000')),
+                    n_threads=max(1, (os.cpu_count() or 1) - 1))
+
+    section_words = []
+    for section in docs:
+        # pull token attributes out of Spacy in one call: lowercase, lemma, stop word, punctuation, whitespace
+        attributes = section.to_array([LOWER, LEMMA, IS_STOP, IS_PUNCT, IS_SPACE])
+
+        # strip whitespace, punctuation and stop words if requested
+        keep = (attributes[:, 3] == 0) & (attributes[:, 4] == 0)
+        if remove_stopwords:
+            keep &= attributes[:, 2] == 0
+
+        # convert word to lowercase and lemmatize if requested
+        if lemmatize_words:
+            word_hashes = np.where(attributes[keep, 1] != pron_hash, attributes[keep, 1], attributes[keep, 0])
+        else:
+            word_hashes = attributes[keep, 0]
+
+        # add each parsed word into a list, interned so repeated words share one string object across sections
+        section_words.append([sys.intern(strings[word_hash]) for word_hash in word_hashes.tolist()])
+
+    return section_words
+
 
 class ParseAndModel:
     """
@@ -44,7 +107,8 @@ class ParseAndModel:
                  start_line: int = 0,
                  lemmatize_words: bool = True,
                  log_base: int = None,
-                 include_title_lines: bool = True):
+                 include_title_lines: bool = True,
+                 n_jobs: int = 1):
         """
 
 
@@ -64,6 +128,7 @@ class ParseAndModel:
         :param log_base: Optional parameter to specify log base, defaults to ln if not set
         :param include_title_lines: Set to true to include lines as marked in title lines in the output, false otherwise
             only valid for annotated data input
+        :param n_jobs: Number of worker processes used to parse sections with Spacy, 1 parses in the current process
         """
         # Test nltk dependencies
         nltk_punkt = nltk.data.find('tokenizers/punkt')
@@ -104,7 +169,8 @@ class ParseAndModel:
         else:
             self.model_results = self.build_explicit_models(remove_stopwords=remove_stopwords,
                                                             lemmatize_words=lemmatize_words,
-                                                            log_base=log_base
+                                                            log_base=log_base,
+                                                            n_jobs=n_jobs
                                                             )
 
         # self.parsed_text2 = ParseAndModel.read_file_data(filename=filename, nlines=nlines, start_line=start_line)
@@ -185,101 +251,63 @@ class ParseAndModel:
                 key: feature name
                 value: number of sections in which the feature appears
        """
-        doc_id = -1
-        section_id = 0
-        section_list = []
-        feature_section_mapping = []
-        feature_list = defaultdict(int)
-        line_number = 0
-        line_count = 0
-
+        # Read the requested range of lines, at least one line is always read
         with open(filename, 'r') as input_file:
-            for line in input_file:
-
-                # Skip line if before specified start
-                if line_number < start_line:
-                    # Increment line number
-                    line_number += 1
-                    continue
-                else:
-                    # Increment line number
-                    line_number += 1
-
-                # Section is from new doc, increment doc id
-                if '[t]' in line:
-                    doc_id += 1
-                    is_title = True
-                    line_text = line.split('[t]')[1].strip().lower()
-
-                # Section is from new doc, increment doc id
-                elif line.startswith('*'):
-                    doc_id += 1
-                    is_title = True
-                    line_text = line.split('*')[1].strip().lower()
-
-                # Section not from new doc, just get cleaned text
-                else:
-                    is_title = False
-                    line_text = line.split('##')[1].strip().lower()
-
-                # If we still haven't seen a title increment the document id anyway
-                if doc_id == -1:
-                    doc_id += 1
-
-                # Look for feature annotations attached to the line
-                feature_string = line.split('##')[0].split(',')
-                logging.debug(feature_string)
-                if not is_title and feature_string[0] != '':
-
-                    # Loop through all the features found in the annotation
-                    for feature in feature_string:
-                        logging.debug(feature)
-
-                        # Check if the feature in the annotation is marked as an implicit mention
-                        if '[u]' in feature:
-                            explicit_feature = False
-                            logging.debug('implicit')
-                        else:
-                            explicit_feature = True
-
-                        # Get the actual text of the feature
-                        feature_text = feature.split('[@]')[0]
-
-                        # Add the feature and section id to the data set
-                        feature_section_mapping.append(
-                            {"doc_id": doc_id, "section_id": section_id, "feature": feature_text,
-                             "is_explicit": explicit_feature})
-
-                        # Increment the feature in the unique feature list
-                        feature_list[feature_text] += 1
-
-                # Check if title lines should be included
-                if not include_title_lines and is_title:
-                    # Check if max number of lines has been reached yet
-                    line_count += 1
-                    if nlines is not None:
-                        if line_count >= nlines:
-                            break
-
-                    continue
-
-                # Add section line to data set
-                section_list.append(
-                    {"doc_id": doc_id, "section_id": section_id, "section_text": line_text, "title": is_title})
-
-                # Increment section id
-                section_id += 1
-                line_count += 1
-                logging.debug(line)
-
-                # Check if max number of lines has been reached yet
-                if nlines is not None:
-                    if line_count >= nlines:
-                        break
+            lines = pd.Series(list(islice(input_file, start_line,
+                                          None if nlines is None else start_line + max(nlines, 1))), dtype=object)
+
+        if lines.empty:
+            return dict(section_list=pd.DataFrame(), feature_mapping=pd.DataFrame(), feature_list=Counter())
+
+        # Split annotations from section text once
+        line_parts = lines.str.partition('##')
+        annotation = line_parts[0]
+
+        # Title lines start a new doc, marked either with [t] or a leading *
+        is_t_title = lines.str.startswith('[t]')
+        is_star_title = ~is_t_title & lines.str.startswith('*')
+        is_title = is_t_title | is_star_title
+
+        # Get cleaned text for titles and sections
+        title_text = lines.str.partition('[t]')[2].where(is_t_title, lines.str[1:].str.partition('*')[0])
+        line_text = line_parts[2].str.partition('##')[0].where(~is_title, title_text).str.strip().str.lower()
+
+        # Each title increments the doc id, if we haven't seen a title yet the first lines belong to doc 0
+        doc_ids = is_title.astype(np.int64).cumsum() - (1 if is_title.iloc[0] else 0)
+
+        # Section ids are only assigned to lines that are kept
+        is_kept = ~is_title if not include_title_lines else pd.Series(True, index=lines.index)
+        section_ids = is_kept.astype(np.int64).cumsum() - 1
+
+        section_list = pd.DataFrame({"doc_id": doc_ids[is_kept].values, "section_id": section_ids[is_kept].values,
+                                     "section_text": line_text[is_kept].values, "title": is_title[is_kept].values},
+                                    columns=["doc_id", "section_id", "section_text", "title"])
+
+        # Look for feature annotations attached to non title lines, no annotations found gives an empty mapping
+        has_features = ~is_title & (annotation != '') & ~annotation.str.startswith(',')
+        if has_features.any():
+            feature_strings = annotation[has_features].str.split(',')
+            feature_counts = feature_strings.map(len).values
+            features = pd.Series(list(chain.from_iterable(feature_strings)), dtype=object)
+            logging.debug(features)
+
+            # Check if the feature in the annotation is marked as an implicit mention and get the actual text
+            feature_section_mapping = pd.DataFrame(
+                {"doc_id": np.repeat(doc_ids[has_features].values, feature_counts),
+                 "feature": features.str.partition('[@]')[0].values,
+                 "is_explicit": ~features.str.contains('[u]', regex=False).values,
+                 "section_id": np.repeat(section_ids[has_features].values, feature_counts)},
+                columns=["doc_id", "feature", "is_explicit", "section_id"])
+
+            # Count the sections each feature appears in
+            feature_list = Counter(feature_section_mapping["feature"].values)
+        else:
+            feature_section_mapping = pd.DataFrame()
+            feature_list = Counter()
 
         # Bundle and save data set
         # TODO: [nfr] remove this from here, return dictionary and make assignment in __init__
-        return dict(section_list=pd.DataFrame(section_list), feature_mapping=pd.DataFrame(feature_section_mapping),
+        return dict(section_list=section_list, feature_mapping=feature_section_mapping,
                     feature_list=feature_list)
 
     # TODO: add tests, alterate file formats
@@ -348,7 +376,9 @@ class ParseAndModel:
     # TODO: Slow, needs to be optimized, unit tests need to be added
     def build_explicit_models(self, remove_stopwords: bool = True,
                               lemmatize_words: bool = True,
-                              log_base: int = None) -> dict:
+                              log_base: int = None,
+                              n_jobs: int = 1,
+                              chunk_size: int = 512) -> dict:
         """
         This function builds a background model, set of topic models and summarizes the counts of words in each sentence
             to prepare for EM optimization
@@ -358,6 +388,8 @@ class ParseAndModel:
         :param lemmatize_words: Set to true if lemmatization should be performed on document sections before models are
             created
         :param log_base: Optional parameter to specify log base, defaults to ln if not set
+        :param n_jobs: Number of worker processes used to parse sections with Spacy, 1 parses in the current process
+        :param chunk_size: Number of sections sent to a worker process at a time when n_jobs > 1
         :return: a dictionary with six entries -
             model_background: background model estimated from the entire document collection as described in section 4.2
             model_feature: feature models estimated from explicit mention sections as described in section 4.2
@@ -400,8 +432,6 @@ class ParseAndModel:
         section_word_counts = dict()  # count of words in each section
         collection_word_counts = Counter()  # count of all words in all section
         word_section_counter = Counter()  # count of number of sections with word
-        feature_word_counter = defaultdict(
-            Counter)  # keep track of words appearing in section w/ explicit feature mention
         feature_section_mapping = []  # keeps a list of the sentence ids associated with each feature (many-to-many mapping)
 
         vocabulary = OrderedDict()
@@ -409,79 +439,65 @@ class ParseAndModel:
 
         unique_feature_ids = feature_set.feature_id.unique()
 
-        # initialize Spacy model
-        nlp = en_core_web_sm.load()
-
-        annotated_text = text_set['section_text'].values.tolist()
-        docs = nlp.pipe(annotated_text, batch_size=1000, n_threads=4)
-        section_list = []
-        for item in docs:
-            section_list.append(item)
-
-        # loop over all rows in input data set
-        for index, row in text_set.iterrows():
-            # print the current text for debugging
-            logging.debug(str(row["section_id"]) + ": " + row["section_text"])
-
-            # input the sentence into Spacy
-            section = section_list[index]  # nlp(row["section_text"])
-
-            # add each parsed word into a list
-            current_section_words = []
-            for word in section:
-                if word.lower_.strip() == '':
-                    continue
-
-                # convert word to lowercase, strip stop words and lemmatize if requested
-                if (not word.is_stop or not remove_stopwords) and not word.is_punct:
-                    cleaned_word = word.lemma_ if (word.lemma_ != '-PRON-' and lemmatize_words) else word.lower_
-                    current_section_words.append(cleaned_word)
+        # lookup from feature id to the set of its feature strings (including synonyms)
+        feature_words = defaultdict(set)
+        for feature, feature_id in zip(feature_set["feature"].tolist(), feature_set["feature_id"].tolist()):
+            feature_words[feature_id].add(feature)
+
+        # parse sections into cleaned word lists, splitting into chunks over worker processes if requested
+        section_ids = text_set['section_id'].tolist()
+        annotated_text = text_set['section_text'].values
+        if n_jobs > 1 and len(annotated_text) > chunk_size:
+            chunks = [annotated_text[i:i + chunk_size] for i in range(0, len(annotated_text), chunk_size)]
+
+            # load the model before starting the pool so forked workers inherit it, spawned workers load it once each
+            # through the module level cache
+            _get_nlp()
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                parsed_sections = list(chain.from_iterable(
+                    executor.map(_parse_sections, chunks, repeat(remove_stopwords), repeat(lemmatize_words))))
+
+            # words come back unpickled as new string objects, intern them again in this process
+            parsed_sections = [[sys.intern(word) for word in section_words] for section_words in parsed_sections]
+        else:
+            parsed_sections = _parse_sections(annotated_text, remove_stopwords, lemmatize_words)
 
-                    # assign word an id if it doesn't have one already
-                    if cleaned_word not in vocabulary:
-                        current_word_id += 1
-                        vocabulary[cleaned_word] = current_word_id
+        # loop over all parsed sections in input data set
+        for section_id, current_section_words in zip(section_ids, parsed_sections):
+            # print the current words for debugging
+            logging.debug("%s: %s", section_id, current_section_words)
 
             # get a count of distinct words in the section - this might need to be switched to default dict later
             current_section_word_counts = Counter(current_section_words)
 
+            # assign each word an id if it doesn't have one already
+            for cleaned_word in current_section_word_counts:
+                if cleaned_word not in vocabulary:
+                    current_word_id += 1
+                    vocabulary[cleaned_word] = current_word_id
+
             # get keys for distinct words to add to idf counter
             word_section_counter.update(current_section_word_counts.keys())
 
             # add these counts to the all section counter
-            collection_word_counts.update(current_section_words)
+            collection_word_counts.update(current_section_word_counts)
 
             # add to section counts dictionary
-            section_word_counts[row["section_id"]] = current_section_word_counts
+            section_word_counts[section_id] = current_section_word_counts
 
             # add to dictionary holding word parsing
-            section_word_list[row["section_id"]] = current_section_words
+            section_word_list[section_id] = current_section_words
 
-            # initialize list to keep track of found features (in case of synonyms)
-            found_features = set()
+            # distinct words in the section as a set, so checking a feature costs O(synonyms) not O(section words)
+            section_word_set = set(current_section_word_counts)
 
-            # get all explicit topics for this sentence and add these words to the list
-            for index_f, row_f in feature_set.iterrows():
-
-                # word was found in the section, record find and add words to feature topic model
-                if row_f["feature"] in current_section_words:
-                    logging.debug("feature " + str(row_f["feature_id"]))
-
-                    if row_f["feature_id"] in found_features:
-                        # already found explicit feature mention in sentence as synonym, skip
-                        continue
-                    else:
-                        # feature has not been found yet, add to the list
-                        found_features.add(row_f["feature_id"])
-
-                    # record that feature was explicitly found
-                    feature_section_mapping.append({"section_id": row["section_id"], "explicit_feature_id": row_f["feature_id"]})
-
-                    # if we only count each word once
-                    # feature_word_counter[row_f["feature_id"]].update(current_section_word_counts.keys())
-
-                    # if we count each words as many times as it occurs (consistent with Santu's code)
-                    feature_word_counter[row_f["feature_id"]].update(current_section_words)
+            # record each explicit feature mentioned in this section (once, in case of synonyms), words are added to
+            # feature topic model once vocabulary is known
+            for feature_id, words in feature_words.items():
+                if words.isdisjoint(section_word_set):
+                    continue
+                logging.debug("feature " + str(feature_id))
+                feature_section_mapping.append({"section_id": section_id, "explicit_feature_id": feature_id})
 
         # At this point we have all the counts we need to build the topic models
 
@@ -489,82 +505,83 @@ class ParseAndModel:
         # Calculations for background model
         ####################################
 
-        # total number of words
-        vocabulary_size = len(collection_word_counts.values())
-        total_word_count = sum(collection_word_counts.values())
-
-        # change counter to dictionary for calculations
-        collection_word_counts = dict(collection_word_counts)
+        # count of each word in the collection, in vocabulary order
+        vocabulary_size = len(vocabulary)
+        collection_counts = np.array([collection_word_counts[word] for word in vocabulary])
 
         # calculate background model - ensure words are in key order
-        model_background = []
-        for word, word_id in vocabulary.items():
-            model_background.append(collection_word_counts[word] / total_word_count)
+        model_background_vector = collection_counts / collection_counts.sum()
+        model_background = model_background_vector.tolist()
 
         ###############################
         # Calculations for topic model
         ###############################
-        tfidf_feature = defaultdict(dict)
-        model_feature_norms = Counter()
 
         # count of sentences
         section_count = len(section_word_list)
 
-        for word in collection_word_counts.keys():
-
-            for current_feature in unique_feature_ids:
-
-                #######################################################################################################
-                # Formula 4, section 4.2, using base e logs by default but can be changed, also adds +1 from Formula 5
-                #######################################################################################################
-                if log_base is None:
-                    tfidf = math.log(1 + feature_word_counter[current_feature][word]) \
-                            * math.log(1 + section_count / word_section_counter[word]) \
-                            + 1
-                else:
-                    tfidf = math.log(1 + feature_word_counter[current_feature][word], log_base) \
-                            * math.log(1 + section_count / word_section_counter[word], log_base) \
-                            + 1
-                logging.debug(str(tfidf))
-
-                tfidf_feature[current_feature][word] = tfidf
-
-                model_feature_norms[current_feature] += tfidf
-
-        # normalize values of all dictionaries with totals
-        model_feature = []
-
-        for index in feature_set["feature_id"].unique():
-            logging.debug("normalizing " + str(index))
-
-            #########################################################################################################
-            # Formula 5, section 4.2, using base e logs by default, +1 in numerator already taken care of in tfidf calculation
-            #########################################################################################################
-            model_feature.append([])
-            for word, word_id in vocabulary.items():
-                logging.debug(word + ":" + str(word_id))
-                model_feature[index].append(tfidf_feature[index][word] / (model_feature_norms[index]))
-
-        # translate section word counts into matrix for EM
-        section_word_counts_matrix = np.zeros(shape=(section_count, vocabulary_size))
+        # keep track of words appearing in section w/ explicit feature mention, features in rows and words in
+        # vocabulary order
+        feature_word_counts_matrix = np.zeros(shape=(len(unique_feature_ids), vocabulary_size), dtype=np.int32)
+        for mapping in feature_section_mapping:
+            word_counts = section_word_counts[mapping["section_id"]]
+            word_ids = [vocabulary[word] for word in word_counts]
+
+            # if we only count each word once
+            # feature_word_counts_matrix[mapping["explicit_feature_id"], word_ids] += 1
+
+            # if we count each words as many times as it occurs (consistent with Santu's code)
+            feature_word_counts_matrix[mapping["explicit_feature_id"], word_ids] += list(word_counts.values())
+
+        # number of sections containing each word, in vocabulary order
+        word_section_counts = np.array([word_section_counter[word] for word in vocabulary])
+
+        #######################################################################################################
+        # Formula 4, section 4.2, using base e logs by default but can be changed, also adds +1 from Formula 5
+        #######################################################################################################
+        if log_base is None:
+            tfidf = np.log(1 + feature_word_counts_matrix) * np.log(1 + section_count / word_section_counts)
+        elif log_base == 2:
+            tfidf = np.log2(1 + feature_word_counts_matrix) * np.log2(1 + section_count / word_section_counts)
+        elif log_base == 10:
+            tfidf = np.log10(1 + feature_word_counts_matrix) * np.log10(1 + section_count / word_section_counts)
+        else:
+            tfidf = np.log(1 + feature_word_counts_matrix) * np.log(1 + section_count / word_section_counts) \
+                    / math.log(log_base) ** 2
+        tfidf += 1
+        logging.debug(str(tfidf))
+
+        #########################################################################################################
+        # Formula 5, section 4.2, using base e logs by default, +1 in numerator already taken care of in tfidf calculation
+        #########################################################################################################
+        model_feature_norms = tfidf / tfidf.sum(axis=1, keepdims=True)
+        model_feature = model_feature_norms.tolist()
+
+        # translate section word counts into sparse matrix for EM, built from (section, word id, count) triplets so
+        # no dense section x vocabulary array is allocated
+        section_rows = []
+        word_columns = []
+        word_counts_data = []
         for section, word_list in section_word_counts.items():
             logging.debug(section)
-            for word, word_count in word_list.items():
-                # look up current word
-                word_id = vocabulary[word]
-                logging.debug(str(word_id) + ":" + word)
-                section_word_counts_matrix[section, word_id] = word_count
+            section_rows.extend([section] * len(word_list))
+            word_columns.extend([vocabulary[word] for word in word_list])
+            word_counts_data.extend(word_list.values())
+        section_word_counts_matrix = csr_matrix((np.array(word_counts_data, dtype=np.int32),
+                                                 (np.array(section_rows, dtype=np.int32),
+                                                  np.array(word_columns, dtype=np.int32))),
+                                                shape=(section_count, vocabulary_size))
 
         # translate models into matrices for EM
-        model_background_matrix = csr_matrix(np.array(model_background).T)
-        model_feature_matrix = np.array(model_feature).T
+        model_background_matrix = csr_matrix(model_background_vector)
+        model_feature_matrix = model_feature_norms.T
 
         # reverse vocabulary dictionary so it can be used to back-translate later
         vocabulary_lookup = {v: k for k, v in vocabulary.items()}
 
         # Save model results to object
         return dict(model_background=model_background, model_feature=model_feature,
-                    section_word_counts_matrix=csr_matrix(section_word_counts_matrix),
+                    section_word_counts_matrix=section_word_counts_matrix,
                     model_background_matrix=model_background_matrix, model_feature_matrix=model_feature_matrix,
                     vocabulary_lookup=vocabulary_lookup, feature_section_mapping =pd.DataFrame(feature_section_mapping))
 
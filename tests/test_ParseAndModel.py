@@ -201,6 +201,65 @@ class TestParseAndModel(TestCase):
         self.assertEqual(True, pd.DataFrame.equals(df_feature_mapping, pm.parsed_text["feature_mapping"]))
         self.assertEqual(True, dict(df_feature_list) == dict(pm.parsed_text["feature_list"]))
 
+    def test_read_annotated_dat_title_types(self):
+        pm = ParseAndModel()
+
+        df_section_list = pd.DataFrame([[0, 0, "untitled first line", False]
+                                           , [0, 1, "untitled second line with sound", False]
+                                           , [1, 2, "star title", True]
+                                           , [1, 3, "the battery is fine", False]
+                                           , [2, 4, "bracket title", True]
+                                           , [2, 5, "last line", False]
+                                        ], columns=["doc_id", "section_id", "section_text", "title"])
+        df_feature_mapping = pd.DataFrame([[0, "sound", True, 1]
+                                              , [1, "battery", True, 3]
+                                              , [1, "size", False, 3]],
+                                          columns=["doc_id", "feature", "is_explicit", "section_id"])
+        df_feature_list = defaultdict(int)
+        df_feature_list["sound"] = 1
+        df_feature_list["battery"] = 1
+        df_feature_list["size"] = 1
+
+        pm.parsed_text = pm.read_annotated_data(filename='data/parse_and_model/titleTypesTest.txt')
+
+        self.assertEqual(True, pd.DataFrame.equals(df_section_list, pm.parsed_text["section_list"]))
+        self.assertEqual(True, pd.DataFrame.equals(df_feature_mapping, pm.parsed_text["feature_mapping"]))
+        self.assertEqual(True, dict(df_feature_list) == dict(pm.parsed_text["feature_list"]))
+
+    def test_read_annotated_dat_exclude_titles_nlines(self):
+        pm = ParseAndModel()
+
+        df_section_list = pd.DataFrame([[0, 0, "untitled first line", False]
+                                           , [0, 1, "untitled second line with sound", False]
+                                           , [1, 2, "the battery is fine", False]
+                                        ], columns=["doc_id", "section_id", "section_text", "title"])
+        df_feature_mapping = pd.DataFrame([[0, "sound", True, 1]
+                                              , [1, "battery", True, 2]
+                                              , [1, "size", False, 2]],
+                                          columns=["doc_id", "feature", "is_explicit", "section_id"])
+
+        pm.parsed_text = pm.read_annotated_data(filename='data/parse_and_model/titleTypesTest.txt', nlines=4,
+                                                include_title_lines=False)
+
+        self.assertEqual(True, pd.DataFrame.equals(df_section_list, pm.parsed_text["section_list"]))
+        self.assertEqual(True, pd.DataFrame.equals(df_feature_mapping, pm.parsed_text["feature_mapping"]))
+
+    def test_read_annotated_dat_star_title_first(self):
+        pm = ParseAndModel()
+
+        df_section_list = pd.DataFrame([[0, 0, "star title", True]
+                                           , [0, 1, "the battery is fine", False]
+                                        ], columns=["doc_id", "section_id", "section_text", "title"])
+        df_feature_mapping = pd.DataFrame([[0, "battery", True, 1]
+                                              , [0, "size", False, 1]],
+                                          columns=["doc_id", "feature", "is_explicit", "section_id"])
+
+        pm.parsed_text = pm.read_annotated_data(filename='data/parse_and_model/titleTypesTest.txt', nlines=2,
+                                                start_line=2)
+
+        self.assertEqual(True, pd.DataFrame.equals(df_section_list, pm.parsed_text["section_list"]))
+        self.assertEqual(True, pd.DataFrame.equals(df_feature_mapping, pm.parsed_text["feature_mapping"]))
+
     def test_bem_one_section(self):
         pm = ParseAndModel()
 
@@ -266,6 +325,76 @@ class TestParseAndModel(TestCase):
         self.assertEqual(True, np.array_equiv(expected_model_feature_matrix,
                                               np.round(pm.model_results["model_feature_matrix"], 3)))
         self.assertEqual(True, expected_vocab_lookup == pm.model_results["vocabulary_lookup"])
+        self.assertEqual(True, isinstance(pm.model_results["section_word_counts_matrix"], csr_matrix))
+        self.assertEqual((2, 5), pm.model_results["section_word_counts_matrix"].shape)
+        self.assertEqual(np.int32, pm.model_results["section_word_counts_matrix"].dtype)
+
+    def expected_two_section_model_feature(self, log_base):
+        # Formula 4 and 5 computed with math.log for the two section data set below
+        feature_counts = [1, 1, 1, 0, 0]
+        section_counts = [2, 1, 1, 1, 1]
+        tfidf = [math.log(1 + count, log_base) * math.log(1 + 2 / section_count, log_base) + 1
+                 for count, section_count in zip(feature_counts, section_counts)]
+        return [[value / sum(tfidf) for value in tfidf]]
+
+    def test_bem_two_section_log_base_10(self):
+        pm = ParseAndModel()
+
+        section_list = pd.DataFrame([[0, 0, "large clear screen", True]
+                                        , [0, 1, "large broken bad", True]
+                                     ], columns=["doc_id", "section_id", "section_text", "title"])
+
+        pm.feature_list = ["screen"]
+        pm.formatted_feature_list = pm.format_feature_list()
+
+        pm.parsed_text = dict(section_list=section_list)
+        pm.model_results = pm.build_explicit_models(lemmatize_words=False, log_base=10)
+
+        expected_model_feature = self.expected_two_section_model_feature(log_base=10)
+
+        self.assertEqual(True, np.allclose(expected_model_feature, pm.model_results["model_feature"],
+                                           rtol=0, atol=1e-12))
+        self.assertEqual(True, np.allclose(np.array(expected_model_feature).T,
+                                           pm.model_results["model_feature_matrix"], rtol=0, atol=1e-12))
+
+    def test_bem_two_section_log_base_3(self):
+        pm = ParseAndModel()
+
+        section_list = pd.DataFrame([[0, 0, "large clear screen", True]
+                                        , [0, 1, "large broken bad", True]
+                                     ], columns=["doc_id", "section_id", "section_text", "title"])
+
+        pm.feature_list = ["screen"]
+        pm.formatted_feature_list = pm.format_feature_list()
+
+        pm.parsed_text = dict(section_list=section_list)
+        pm.model_results = pm.build_explicit_models(lemmatize_words=False, log_base=3)
+
+        expected_model_feature = self.expected_two_section_model_feature(log_base=3)
+
+        self.assertEqual(True, np.allclose(expected_model_feature, pm.model_results["model_feature"],
+                                           rtol=0, atol=1e-12))
+        self.assertEqual(True, np.allclose(np.array(expected_model_feature).T,
+                                           pm.model_results["model_feature_matrix"], rtol=0, atol=1e-12))
+
+    def test_bem_parallel_matches_serial(self):
+        pm = ParseAndModel(feature_list=["sound", "battery", ["screen", "display"]],
+                           filename='data/parse_and_model/iPod.final', nlines=20)
+
+        serial_results = pm.build_explicit_models(n_jobs=1)
+        parallel_results = pm.build_explicit_models(n_jobs=2, chunk_size=1)
+
+        self.assertEqual(True, serial_results["model_background"] == parallel_results["model_background"])
+        self.assertEqual(True, serial_results["model_feature"] == parallel_results["model_feature"])
+        self.assertEqual(True, np.array_equal(serial_results["section_word_counts_matrix"].toarray(),
+                                              parallel_results["section_word_counts_matrix"].toarray()))
+        self.assertEqual(True, np.array_equal(serial_results["model_background_matrix"].toarray(),
+                                              parallel_results["model_background_matrix"].toarray()))
+        self.assertEqual(True, np.array_equal(serial_results["model_feature_matrix"],
+                                              parallel_results["model_feature_matrix"]))
+        self.assertEqual(True, serial_results["vocabulary_lookup"] == parallel_results["vocabulary_lookup"])
+        self.assertEqual(True, pd.DataFrame.equals(serial_results["feature_section_mapping"],
+                                                   parallel_results["feature_section_mapping"]))
 
     def test_constructor_one_section(self):
         pm = ParseAndModel(feature_list=["screen"], filename='data/parse_and_model/twoLineTest.txt',